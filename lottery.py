@@ -1,108 +1,226 @@
 # Improvements to the Lottery contract:
 #  - buy_ticket is now buy_tickets with an additional parameter n for the
 #    number of tickets the user will buy.
-#  - update_ticket_cost(new_cost) will update the cost of ticket to new_cost.
-#  - update_max_tickets(new_max) will update the maximum number of tickets to
+#  - admin_update(new_cost) will update the cost of ticket to new_cost.
+#  - admin_update(new_max) will update the maximum number of tickets to
 #    new_max.
+#  - admin_update(new_seed_hash) will commit blake2b(secret) for the next
+#    game. The secret is revealed when calling end_game(secret).
 #
-# Both the update_ticket_cost() and update_max_tickets() can only be called by
-# the contract admin. The contract admin refers to my own account. If you want to
-# originate this contract, make sure to replace the assigned address to the admin
-# attribute of the contract and the assigned address to the admin alias in the test()
-# function.
+# The winner is drawn by reservoir sampling while the tickets are bought. Those
+# draws only use public data (seed hash, block level, epoch and tickets sold),
+# so a buyer can time a purchase to become the current winner. The purchase
+# that closes the game is drawn in end_game() with the revealed secret instead,
+# so no buyer, including the closing one, can make sure to win. The admin knows
+# the secret in advance and must not take part in the game.
+#
+# admin_update() can only be called by the contract admin. The contract admin
+# refers to my own account. If you want to originate this contract, make sure to
+# replace the assigned address to the admin attribute of the contract and the
+# assigned address to the admin alias in the test() function.
+
+import json
 
 import smartpy as sp
 
+# Upper bound for max_tickets. Since n <= tickets_available <= max_tickets is
+# checked before the cost multiplication in buy_tickets, n * ticket_cost stays
+# well within the mutez range for any realistic ticket cost.
+MAX_TICKETS_CAP = 1000000
+
+# Error codes. Their messages are published in the contract metadata (TZIP-16)
+# instead of being stored as strings in the contract script.
+ERR_INVALID_AMOUNT = 1
+ERR_ZERO_TICKETS = 2
+ERR_TICKETS_EXCEEDED = 3
+ERR_NO_TICKETS = 4
+ERR_NOT_ADMIN = 5
+ERR_GAME_ONGOING = 6
+ERR_ZERO_MAX_TICKETS = 7
+ERR_MAX_TICKETS_TOO_LARGE = 8
+ERR_GAME_NOT_ENDED = 9
+ERR_NO_SEED_HASH = 10
+ERR_INVALID_SECRET = 11
+
+ERROR_MESSAGES = {
+    ERR_INVALID_AMOUNT: "INVALID AMOUNT",
+    ERR_ZERO_TICKETS: "ZERO TICKETS",
+    ERR_TICKETS_EXCEEDED: "REQUESTED AMOUNT OF TICKETS EXCEED THE REMAINING AMOUNT OF TICKETS",
+    ERR_NO_TICKETS: "NO TICKETS AVAILABLE",
+    ERR_NOT_ADMIN: "THIS ENTRY POINT CAN ONLY BE CALLED BY THE CONTRACT ADMIN",
+    ERR_GAME_ONGOING: "CANNOT UPDATE THE GAME SETTINGS WHILE A GAME IS ONGOING",
+    ERR_ZERO_MAX_TICKETS: "MAXIMUM AMOUNT OF TICKETS CANNOT BE ZERO",
+    ERR_MAX_TICKETS_TOO_LARGE: f"MAXIMUM AMOUNT OF TICKETS CANNOT EXCEED {MAX_TICKETS_CAP}",
+    ERR_GAME_NOT_ENDED: "GAME IS YET TO END",
+    ERR_NO_SEED_HASH: "NO SEED HASH COMMITTED FOR THIS GAME",
+    ERR_INVALID_SECRET: "SECRET DOES NOT MATCH THE SEED HASH",
+}
+
+METADATA = {
+    "name": "Lottery",
+    "version": "1.0.0",
+    "interfaces": ["TZIP-016"],
+    "errors": [
+        {"error": {"int": str(code)}, "expansion": {"string": message}, "languages": ["en"]}
+        for code, message in ERROR_MESSAGES.items()
+    ],
+}
+
+def sub_nat_unchecked(a, b):
+    # a - b as a nat, compiled to SUB; ABS instead of the ISNAT check emitted
+    # by sp.as_nat. Only use this when a >= b has already been verified.
+    return abs(a - b)
+
 class Lottery(sp.Contract):
     def __init__(self):
         self.init(
             admin = sp.address("tz1fcNTRug7RXfixJWttCcReTVXSLt2UozSU"),
-            players = sp.map(l={}, tkey=sp.TNat, tvalue=sp.TAddress),
+            winner = sp.none,
+            tickets_sold = sp.nat(0),
             ticket_cost = sp.tez(1),
             tickets_available = sp.nat(5),
             max_tickets = sp.nat(5),
+            closing_purchase = sp.none,
+            seed_hash = sp.bytes("0x"),
+            epoch = sp.nat(0),
+            metadata = sp.big_map(
+                l = {
+                    "": sp.utils.bytes_of_string("tezos-storage:content"),
+                    "content": sp.utils.bytes_of_string(json.dumps(METADATA)),
+                },
+                tkey = sp.TString,
+                tvalue = sp.TBytes,
+            ),
         )
 
+    def pay_for_tickets(self, n, cost):
+        # Shared by buy_tickets and buy_all_remaining: charges the sender for
+        # n tickets and refunds any extra tez. Returns the sender.
+        sender = sp.local("sender", sp.sender)
+        amt = sp.local("amt", sp.amount)
+
+        # Sanity checks
+        sp.verify(self.data.seed_hash != sp.bytes("0x"), ERR_NO_SEED_HASH)
+        total_cost = sp.mul(n, cost)
+        sp.verify(amt.value >= total_cost, ERR_INVALID_AMOUNT)
+
+        # Storage updates
+        self.data.tickets_sold += n
+
+        # Return extra tez balance to the sender
+        sp.if amt.value > total_cost:
+            sp.send(sender.value, amt.value - total_cost)
+
+        return sender.value
+
+    def draw_winner(self, buyer, n, entropy):
+        # Reservoir sampling: the n tickets of buyer replace the current winner
+        # with probability n / tickets_sold, so that every ticket sold so far
+        # has the same chance of winning.
+        sold = sp.local("sold", self.data.tickets_sold)
+        draw = sp.blake2b(entropy + sp.pack((self.data.epoch, sold.value)))
+        sp.if abs(sp.to_int(draw)) % sold.value < n:
+            self.data.winner = sp.some(buyer)
+
     @sp.entry_point
     def buy_tickets(self, params):
         # params.n : sp.TNat
         #     amount of tickets to be bought.
         sp.set_type(params, sp.TRecord(n=sp.TNat))
 
+        avail = sp.local("avail", self.data.tickets_available)
+
         # Sanity checks
-        total_cost = sp.mul(params.n, self.data.ticket_cost)
-        sp.verify(self.data.tickets_available > 0, "NO TICKETS AVAILABLE")
-        sp.verify(sp.amount >= total_cost, "INVALID AMOUNT")
-        sp.verify(self.data.tickets_available >= params.n, "REQUESTED AMOUNT OF TICKETS EXCEED THE REMAINING AMOUNT OF TICKETS")
+        sp.verify(params.n > 0, ERR_ZERO_TICKETS)
+        sp.verify(avail.value >= params.n, ERR_TICKETS_EXCEEDED)
 
         # Storage updates
-        sp.for _ in sp.range(0, params.n, 1):
-            self.data.players[sp.len(self.data.players)] = sp.sender
-        self.data.tickets_available = sp.as_nat(self.data.tickets_available - params.n)
-
-        # Return extra tez balance to the sender
-        extra_balance = sp.amount - total_cost
-        sp.if extra_balance > sp.mutez(0):
-            sp.send(sp.sender, extra_balance)
+        sender = self.pay_for_tickets(params.n, self.data.ticket_cost)
+        sp.if avail.value == params.n:
+            self.data.closing_purchase = sp.some(sp.record(buyer = sender, n = params.n))
+        sp.else:
+            self.draw_winner(sender, params.n, self.data.seed_hash + sp.pack(sp.level))
+        self.data.tickets_available = sub_nat_unchecked(avail.value, params.n)
 
     @sp.entry_point
-    def update_ticket_cost(self, params):
-        # params.new_cost : sp.TNat
-        #     updated cost of ticket
-        sp.set_type(params, sp.TRecord(new_cost=sp.TMutez))
+    def buy_all_remaining(self):
+        # Same as buy_tickets with n equal to tickets_available, but without
+        # the ticket count check and the subtraction.
+        avail = sp.local("avail", self.data.tickets_available)
 
-        # Sanity checks
-        sp.verify(
-            sp.sender == self.data.admin, 
-            "THIS ENTRY POINT CAN ONLY BE CALLED BY THE CONTRACT ADMIN"
-        )
-        sp.verify(
-            self.data.tickets_available == self.data.max_tickets,
-            "CANNOT UPDATE TICKET COST WHILE A GAME IS ONGOING"
-        )
+        # Sanity checks. Without any tickets left the call would be a no-op
+        # that pays for zero tickets and still reaches the refund path.
+        sp.verify(avail.value > 0, ERR_NO_TICKETS)
 
         # Storage updates
-        self.data.ticket_cost = params.new_cost
+        sender = self.pay_for_tickets(avail.value, self.data.ticket_cost)
+        self.data.closing_purchase = sp.some(sp.record(buyer = sender, n = avail.value))
+        self.data.tickets_available = 0
 
     @sp.entry_point
-    def update_max_tickets(self, params):
-        # params.new_max : sp.TNat
-        #     updated max number of tickets
-        sp.set_type(params, sp.TRecord(new_max = sp.TNat))
+    def admin_update(self, params):
+        # params : sp.TVariant
+        #     new_cost : sp.TMutez
+        #         updated cost of ticket
+        #     new_max : sp.TNat
+        #         updated max number of tickets
+        #     new_seed_hash : sp.TBytes
+        #         blake2b hash of the secret revealed by end_game()
+        sp.set_type(params, sp.TVariant(new_cost = sp.TMutez, new_max = sp.TNat, new_seed_hash = sp.TBytes))
 
         # Sanity checks
         sp.verify(
             sp.sender == self.data.admin, 
-            "THIS ENTRY POINT CAN ONLY BE CALLED BY THE CONTRACT ADMIN"
+            ERR_NOT_ADMIN
         )
         sp.verify(
             self.data.tickets_available == self.data.max_tickets,
-            "CANNOT UPDATE MAXIMUM AMOUNT OF TICKETS WHILE A GAME IS ONGOING"
-        )
-        sp.verify(
-            params.new_max != 0,
-            "MAXIMUM AMOUNT OF TICKETS CANNOT BE ZERO"
+            ERR_GAME_ONGOING
         )
 
         # Storage updates
-        self.data.max_tickets = params.new_max
-        self.data.tickets_available = params.new_max
+        with params.match_cases() as arg:
+            with arg.match("new_cost") as new_cost:
+                self.data.ticket_cost = new_cost
+
+            with arg.match("new_max") as new_max:
+                sp.verify(
+                    new_max != 0,
+                    ERR_ZERO_MAX_TICKETS
+                )
+                sp.verify(
+                    new_max <= MAX_TICKETS_CAP,
+                    ERR_MAX_TICKETS_TOO_LARGE
+                )
+                self.data.max_tickets = new_max
+                self.data.tickets_available = new_max
+
+            with arg.match("new_seed_hash") as new_seed_hash:
+                self.data.seed_hash = new_seed_hash
 
     @sp.entry_point
-    def end_game(self):
+    def end_game(self, params):
+        # params.secret : sp.TBytes
+        #     secret committed with admin_update(new_seed_hash)
+        sp.set_type(params, sp.TRecord(secret = sp.TBytes))
 
         # Sanity checks
-        sp.verify(self.data.tickets_available == 0, "GAME IS YET TO END")
+        sp.verify(self.data.tickets_available == 0, ERR_GAME_NOT_ENDED)
+        sp.verify(sp.blake2b(params.secret) == self.data.seed_hash, ERR_INVALID_SECRET)
 
-        # Pick a winner
-        winner_id = sp.as_nat(sp.now - sp.timestamp(0)) % self.data.max_tickets
-        winner_address = self.data.players[winner_id]
+        # Draw the purchase that closed the game with the revealed secret
+        closing = sp.local("closing", self.data.closing_purchase.open_some())
+        self.draw_winner(closing.value.buyer, closing.value.n, params.secret)
 
         # Send the reward to the winner
-        sp.send(winner_address, sp.balance)
-
-        # Reset the game
-        self.data.players = {}
+        sp.send(self.data.winner.open_some(), sp.balance)
+
+        # Reset the game. winner is kept until the first purchase of the next
+        # game, which always replaces it.
+        self.data.closing_purchase = sp.none
+        self.data.seed_hash = sp.bytes("0x")
+        self.data.tickets_sold = 0
+        self.data.epoch += 1
         self.data.tickets_available = self.data.max_tickets
 
 @sp.add_test(name = "main")
@@ -122,69 +240,138 @@ def test():
     lottery = Lottery()
     scenario += lottery
 
-    # update_ticket_cost
-    scenario.h2("Testing update_ticket_cost()")
+    # admin_update(new_seed_hash)
+    scenario.h2("Testing admin_update(new_seed_hash)")
+
+    scenario.h3("Bob will buy a ticket before a seed hash is committed. (Invalid)")
+    scenario += lottery.buy_tickets(n = 1).run(amount = sp.tez(1), sender = bob, valid = False, exception = ERR_NO_SEED_HASH)
+
+    scenario.h3("Non-admin commits the seed hash. (Invalid)")
+    scenario += lottery.admin_update(sp.variant("new_seed_hash", sp.blake2b(sp.bytes("0x11")))).run(sender = alice, valid = False, exception = ERR_NOT_ADMIN)
+
+    scenario.h3("Admin commits the seed hash. (Valid)")
+    scenario += lottery.admin_update(sp.variant("new_seed_hash", sp.blake2b(sp.bytes("0x11")))).run(sender = admin)
+
+    # admin_update(new_cost)
+    scenario.h2("Testing admin_update(new_cost)")
     
     scenario.h3("Admin updates the ticket cost from 1 tez to 3 tez. (Valid)")
-    scenario += lottery.update_ticket_cost(new_cost = sp.tez(3)).run(sender = admin)
+    scenario += lottery.admin_update(sp.variant("new_cost", sp.tez(3))).run(sender = admin)
 
     scenario.h3("Non-admin updates the ticket cost. (Invalid)")
-    scenario += lottery.update_ticket_cost(new_cost = sp.tez(5)).run(sender = alice, valid = False)
+    scenario += lottery.admin_update(sp.variant("new_cost", sp.tez(5))).run(sender = alice, valid = False, exception = ERR_NOT_ADMIN)
 
     scenario.h3("Admin updates the ticket cost while a game is ongoing. (Invalid)")
     scenario.h4("First, Bob will buy a ticket.")
-    scenario += lottery.buy_tickets(n = 1).run(amount = sp.tez(10), sender = bob)
+    scenario += lottery.buy_tickets(n = 1).run(amount = sp.tez(10), sender = bob, level = 1)
     scenario.h4("Then, the admin updates the ticket cost while the game is ongoing.")
-    scenario += lottery.update_ticket_cost(new_cost = sp.tez(3)).run(sender = admin, valid = False)
+    scenario += lottery.admin_update(sp.variant("new_cost", sp.tez(3))).run(sender = admin, valid = False, exception = ERR_GAME_ONGOING)
     scenario.h4("Let's reset the game by buying all the remaining tickets and call end_game().")
-    scenario += lottery.buy_tickets(n = 4).run(amount = sp.tez(20), sender = bob)
-    scenario += lottery.end_game().run(sender = admin, now = sp.timestamp(20))
+    scenario += lottery.buy_all_remaining().run(amount = sp.tez(20), sender = bob, level = 2)
+    scenario += lottery.end_game(secret = sp.bytes("0x11")).run(sender = admin)
+    scenario += lottery.admin_update(sp.variant("new_seed_hash", sp.blake2b(sp.bytes("0x12")))).run(sender = admin)
 
-    # update_max_tickets
-    scenario.h2("Testing update_max_tickets()")
+    # admin_update(new_max)
+    scenario.h2("Testing admin_update(new_max)")
     
     scenario.h3("Admin updates the maximum tickets from 5 to 10. (Valid)")
-    scenario += lottery.update_max_tickets(new_max = sp.nat(10)).run(sender = admin)
+    scenario += lottery.admin_update(sp.variant("new_max", sp.nat(10))).run(sender = admin)
 
     scenario.h3("Non-admin updates the maximum tickets. (Invalid)")
-    scenario += lottery.update_max_tickets(new_max = sp.nat(3)).run(sender = alice, valid = False)
+    scenario += lottery.admin_update(sp.variant("new_max", sp.nat(3))).run(sender = alice, valid = False, exception = ERR_NOT_ADMIN)
 
     scenario.h3("Admin updates maximum tickets to negative value. (Invalid)")
-    scenario += lottery.update_max_tickets(new_max = sp.nat(0)).run(sender = admin, valid = False)
+    scenario += lottery.admin_update(sp.variant("new_max", sp.nat(0))).run(sender = admin, valid = False, exception = ERR_ZERO_MAX_TICKETS)
+
+    scenario.h3("Admin updates maximum tickets above the cap. (Invalid)")
+    scenario += lottery.admin_update(sp.variant("new_max", sp.nat(MAX_TICKETS_CAP + 1))).run(sender = admin, valid = False, exception = ERR_MAX_TICKETS_TOO_LARGE)
 
     scenario.h3("Admin updates the maximum tickets while a game is ongoing. (Invalid)")
     scenario.h4("First, Bob will buy a ticket.")
-    scenario += lottery.buy_tickets(n = 1).run(amount = sp.tez(10), sender = bob)
+    scenario += lottery.buy_tickets(n = 1).run(amount = sp.tez(10), sender = bob, level = 3)
     scenario.h4("Then, the admin updates the maximum tickets while the game is ongoing.")
-    scenario += lottery.update_max_tickets(new_max = sp.nat(3)).run(sender = admin, valid = False)
+    scenario += lottery.admin_update(sp.variant("new_max", sp.nat(3))).run(sender = admin, valid = False, exception = ERR_GAME_ONGOING)
     scenario.h4("Let's reset the game by buying all the remaining tickets and call end_game().")
-    scenario += lottery.buy_tickets(n = 9).run(amount = sp.tez(100), sender = bob)
-    scenario += lottery.end_game().run(sender = admin, now = sp.timestamp(20))
+    scenario += lottery.buy_all_remaining().run(amount = sp.tez(100), sender = bob, level = 4)
+    scenario += lottery.end_game(secret = sp.bytes("0x12")).run(sender = admin)
 
     # buy_tickets and end_game
     scenario.h2("Testing buy_tickets() and end_game()")
 
-    scenario.h3("First, reset max ticket and ticket cost to their original value.")
-    scenario += lottery.update_max_tickets(new_max = sp.nat(5)).run(sender = admin)
-    scenario += lottery.update_ticket_cost(new_cost = sp.tez(1)).run(sender = admin)
+    scenario.h3("First, reset max ticket and ticket cost to their original value and commit a new seed hash.")
+    scenario += lottery.admin_update(sp.variant("new_max", sp.nat(5))).run(sender = admin)
+    scenario += lottery.admin_update(sp.variant("new_cost", sp.tez(1))).run(sender = admin)
+    scenario += lottery.admin_update(sp.variant("new_seed_hash", sp.blake2b(sp.bytes("0x13")))).run(sender = admin)
 
     scenario.h3("Bob will buy two tickets. (Valid)")
-    scenario += lottery.buy_tickets(n = 2).run(amount = sp.tez(3), sender = bob)
+    scenario += lottery.buy_tickets(n = 2).run(amount = sp.tez(3), sender = bob, level = 5)
 
     scenario.h3("Alice will buy two tickets using only 1 tez. (Invalid)")
-    scenario += lottery.buy_tickets(n = 2).run(amount = sp.tez(1), sender = alice, valid = False)
+    scenario += lottery.buy_tickets(n = 2).run(amount = sp.tez(1), sender = alice, valid = False, exception = ERR_INVALID_AMOUNT)
+
+    scenario.h3("Mike will buy zero tickets. (Invalid)")
+    scenario += lottery.buy_tickets(n = 0).run(amount = sp.tez(1), sender = mike, valid = False, exception = ERR_ZERO_TICKETS)
 
     scenario.h3("Mike will buy more than the available amount of tickets. (Invalid)")
-    scenario += lottery.buy_tickets(n = 6).run(amount = sp.tez(10), sender = mike, valid = False)
+    scenario += lottery.buy_tickets(n = 6).run(amount = sp.tez(10), sender = mike, valid = False, exception = ERR_TICKETS_EXCEEDED)
 
     scenario.h3("End game when there are still unbought tickets. (Invalid)")
-    scenario += lottery.end_game().run(sender = admin, now = sp.timestamp(10), valid = False)
+    scenario += lottery.end_game(secret = sp.bytes("0x13")).run(sender = admin, valid = False, exception = ERR_GAME_NOT_ENDED)
 
     scenario.h3("Bob will buy the remaining tickets. (Valid)")
-    scenario += lottery.buy_tickets(n = 3).run(amount = sp.tez(3), sender = bob)
+    scenario += lottery.buy_tickets(n = 3).run(amount = sp.tez(3), sender = bob, level = 6)
 
     scenario.h3("Mike will buy a ticket even though there's no available ticket left. (Invalid)")
-    scenario += lottery.buy_tickets(n = 1).run(amount = sp.tez(1), sender = mike, valid = False)
+    scenario += lottery.buy_tickets(n = 1).run(amount = sp.tez(1), sender = mike, valid = False, exception = ERR_TICKETS_EXCEEDED)
+
+    scenario.h3("Mike will buy all the remaining tickets even though there's no available ticket left. (Invalid)")
+    scenario += lottery.buy_all_remaining().run(amount = sp.tez(1), sender = mike, valid = False, exception = ERR_NO_TICKETS)
+
+    scenario.h3("End game with a secret that does not match the seed hash. (Invalid)")
+    scenario += lottery.end_game(secret = sp.bytes("0x14")).run(sender = admin, valid = False, exception = ERR_INVALID_SECRET)
 
     scenario.h3("End game when all tickets are bought. (Valid)")
-    scenario += lottery.end_game().run(sender = admin, now = sp.timestamp(10))
+    scenario += lottery.end_game(secret = sp.bytes("0x13")).run(sender = admin)
+
+    scenario.h3("Bob will buy a ticket before the seed hash of the next game is committed. (Invalid)")
+    scenario += lottery.buy_tickets(n = 1).run(amount = sp.tez(1), sender = bob, valid = False, exception = ERR_NO_SEED_HASH)
+
+    # Winner draw. The levels and secrets below are chosen so that each draw
+    # has a known outcome.
+    scenario.h2("Testing the winner draw")
+
+    scenario.h3("The first buyer stays the winner. (Valid)")
+    scenario += lottery.admin_update(sp.variant("new_seed_hash", sp.blake2b(sp.bytes("0x01")))).run(sender = admin)
+    scenario.h4("Alice buys first, so she becomes the winner.")
+    scenario += lottery.buy_tickets(n = 2).run(amount = sp.tez(2), sender = alice, level = 7)
+    scenario.verify(lottery.data.winner == sp.some(alice.address))
+    scenario.h4("Bob's draw at level 8 does not replace Alice.")
+    scenario += lottery.buy_tickets(n = 2).run(amount = sp.tez(2), sender = bob, level = 8)
+    scenario.verify(lottery.data.winner == sp.some(alice.address))
+    scenario.h4("Mike closes the game. His draw is left to end_game().")
+    scenario += lottery.buy_all_remaining().run(amount = sp.tez(1), sender = mike, level = 9)
+    scenario.verify(lottery.data.winner == sp.some(alice.address))
+    epoch = scenario.compute(lottery.data.epoch)
+    scenario.h4("Mike's draw with the revealed secret does not replace Alice, who gets the reward.")
+    scenario += lottery.end_game(secret = sp.bytes("0x01")).run(sender = admin)
+    scenario.verify(lottery.data.winner == sp.some(alice.address))
+    scenario.verify(lottery.balance == sp.tez(0))
+    scenario.verify(lottery.data.closing_purchase.is_none())
+    scenario.verify(lottery.data.tickets_sold == 0)
+    scenario.verify(lottery.data.epoch == epoch + 1)
+
+    scenario.h3("Later buyers replace the winner. (Valid)")
+    scenario += lottery.admin_update(sp.variant("new_seed_hash", sp.blake2b(sp.bytes("0x17")))).run(sender = admin)
+    scenario.h4("Alice buys first, so she becomes the winner.")
+    scenario += lottery.buy_tickets(n = 2).run(amount = sp.tez(2), sender = alice, level = 10)
+    scenario.verify(lottery.data.winner == sp.some(alice.address))
+    scenario.h4("Bob's draw at level 11 replaces Alice.")
+    scenario += lottery.buy_tickets(n = 2).run(amount = sp.tez(2), sender = bob, level = 11)
+    scenario.verify(lottery.data.winner == sp.some(bob.address))
+    scenario.h4("Mike closes the game.")
+    scenario += lottery.buy_tickets(n = 1).run(amount = sp.tez(1), sender = mike, level = 12)
+    scenario.verify(lottery.data.winner == sp.some(bob.address))
+    scenario.h4("Mike's draw with the revealed secret replaces Bob, so Mike gets the reward.")
+    scenario += lottery.end_game(secret = sp.bytes("0x17")).run(sender = admin)
+    scenario.verify(lottery.data.winner == sp.some(mike.address))
+    scenario.verify(lottery.balance == sp.tez(0))